@@ -0,0 +1,85 @@
+# cython: language_level=3
+from cereal import log
+
+LaneChangeState = log.LateralPlan.LaneChangeState
+LaneChangeDirection = log.LateralPlan.LaneChangeDirection
+
+cdef int LC_OFF = LaneChangeState.off
+cdef int LC_PRE = LaneChangeState.preLaneChange
+cdef int LC_STARTING = LaneChangeState.laneChangeStarting
+cdef int LC_FINISHING = LaneChangeState.laneChangeFinishing
+
+cdef int DIR_NONE = LaneChangeDirection.none
+cdef int DIR_LEFT = LaneChangeDirection.left
+cdef int DIR_RIGHT = LaneChangeDirection.right
+
+
+cpdef tuple step(int state, int direction, double wait_timer, double ll_prob, double timer,
+                 bint cancel, bint left_blinker, bint right_blinker, bint prev_one_blinker,
+                 bint below_lane_change_speed, bint steering_pressed, double steering_torque,
+                 bint left_blindspot, bint right_blindspot, double lane_change_prob,
+                 double adjust, double auto_delay, double dt):
+  """Advances the lane change state machine by one planner tick.
+
+  Returns (state, direction, wait_timer, ll_prob, timer).
+  """
+  cdef bint one_blinker = left_blinker != right_blinker
+  cdef bint torque_applied, blindspot_detected
+
+  if cancel:
+    state = LC_OFF
+    direction = DIR_NONE
+  else:
+    # LaneChangeState.off
+    if state == LC_OFF and one_blinker and not prev_one_blinker and not below_lane_change_speed:
+      state = LC_PRE
+      ll_prob = 1.0
+      wait_timer = 0.0
+
+    # LaneChangeState.preLaneChange
+    elif state == LC_PRE:
+      # Set lane change direction
+      if left_blinker:
+        direction = DIR_LEFT
+      elif right_blinker:
+        direction = DIR_RIGHT
+      else:  # If there are no blinkers we will go back to LaneChangeState.off
+        direction = DIR_NONE
+
+      torque_applied = steering_pressed and \
+                       ((steering_torque > 0 and direction == DIR_LEFT) or
+                        (steering_torque < 0 and direction == DIR_RIGHT))
+
+      blindspot_detected = ((left_blindspot and direction == DIR_LEFT) or
+                            (right_blindspot and direction == DIR_RIGHT))
+
+      wait_timer += dt
+      if not one_blinker or below_lane_change_speed:
+        state = LC_OFF
+      elif not blindspot_detected and (torque_applied or (auto_delay != 0.0 and wait_timer > auto_delay)):
+        state = LC_STARTING
+
+    # LaneChangeState.laneChangeStarting
+    elif state == LC_STARTING:
+      # fade out over .5s
+      ll_prob = max(ll_prob - adjust * dt, 0.0)
+
+      # 98% certainty
+      if lane_change_prob < 0.02 and ll_prob < 0.01:
+        state = LC_FINISHING
+
+    # LaneChangeState.laneChangeFinishing
+    elif state == LC_FINISHING:
+      # fade in laneline over 1s
+      ll_prob = min(ll_prob + dt, 1.0)
+      if one_blinker and ll_prob > 0.99:
+        state = LC_PRE
+      elif ll_prob > 0.99:
+        state = LC_OFF
+
+  if state == LC_OFF or state == LC_PRE:
+    timer = 0.0
+  else:
+    timer += dt
+
+  return state, direction, wait_timer, ll_prob, timer
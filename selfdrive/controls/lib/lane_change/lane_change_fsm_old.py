@@ -0,0 +1,71 @@
+from cereal import log
+
+LaneChangeState = log.LateralPlan.LaneChangeState
+LaneChangeDirection = log.LateralPlan.LaneChangeDirection
+
+
+def step(state, direction, wait_timer, ll_prob, timer,
+         cancel, left_blinker, right_blinker, prev_one_blinker,
+         below_lane_change_speed, steering_pressed, steering_torque,
+         left_blindspot, right_blindspot, lane_change_prob,
+         adjust, auto_delay, dt):
+  # python reference of lane_change_fsm.step, kept to test the cython version against
+  one_blinker = left_blinker != right_blinker
+
+  if cancel:
+    state = LaneChangeState.off
+    direction = LaneChangeDirection.none
+  else:
+    # LaneChangeState.off
+    if state == LaneChangeState.off and one_blinker and not prev_one_blinker and not below_lane_change_speed:
+      state = LaneChangeState.preLaneChange
+      ll_prob = 1.0
+      wait_timer = 0.0
+
+    # LaneChangeState.preLaneChange
+    elif state == LaneChangeState.preLaneChange:
+      # Set lane change direction
+      if left_blinker:
+        direction = LaneChangeDirection.left
+      elif right_blinker:
+        direction = LaneChangeDirection.right
+      else:  # If there are no blinkers we will go back to LaneChangeState.off
+        direction = LaneChangeDirection.none
+
+      torque_applied = steering_pressed and \
+                       ((steering_torque > 0 and direction == LaneChangeDirection.left) or
+                        (steering_torque < 0 and direction == LaneChangeDirection.right))
+
+      blindspot_detected = ((left_blindspot and direction == LaneChangeDirection.left) or
+                            (right_blindspot and direction == LaneChangeDirection.right))
+
+      wait_timer += dt
+      if not one_blinker or below_lane_change_speed:
+        state = LaneChangeState.off
+      elif not blindspot_detected and (torque_applied or (auto_delay and wait_timer > auto_delay)):
+        state = LaneChangeState.laneChangeStarting
+
+    # LaneChangeState.laneChangeStarting
+    elif state == LaneChangeState.laneChangeStarting:
+      # fade out over .5s
+      ll_prob = max(ll_prob - adjust * dt, 0.0)
+
+      # 98% certainty
+      if lane_change_prob < 0.02 and ll_prob < 0.01:
+        state = LaneChangeState.laneChangeFinishing
+
+    # LaneChangeState.laneChangeFinishing
+    elif state == LaneChangeState.laneChangeFinishing:
+      # fade in laneline over 1s
+      ll_prob = min(ll_prob + dt, 1.0)
+      if one_blinker and ll_prob > 0.99:
+        state = LaneChangeState.preLaneChange
+      elif ll_prob > 0.99:
+        state = LaneChangeState.off
+
+  if state in (LaneChangeState.off, LaneChangeState.preLaneChange):
+    timer = 0.0
+  else:
+    timer += dt
+
+  return state, direction, wait_timer, ll_prob, timer
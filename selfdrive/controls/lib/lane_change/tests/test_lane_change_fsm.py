@@ -0,0 +1,148 @@
+import random
+import unittest
+
+from cereal import log
+from selfdrive.controls.lib.lane_change import lane_change_fsm
+from selfdrive.controls.lib.lane_change import lane_change_fsm_old
+
+LaneChangeState = log.LateralPlan.LaneChangeState
+LaneChangeDirection = log.LateralPlan.LaneChangeDirection
+
+DT = 0.05
+
+
+class LaneChange:
+  def __init__(self, step, auto_delay=0.0):
+    self.step = step
+    self.auto_delay = auto_delay
+    self.state = LaneChangeState.off
+    self.direction = LaneChangeDirection.none
+    self.wait_timer = 0.0
+    self.ll_prob = 1.0
+    self.timer = 0.0
+    self.prev_one_blinker = False
+
+  def update(self, left_blinker=False, right_blinker=False, cancel=False, below_lane_change_speed=False,
+             steering_pressed=False, steering_torque=0.0, left_blindspot=False, right_blindspot=False,
+             lane_change_prob=0.0, adjust=2.0):
+    self.state, self.direction, self.wait_timer, self.ll_prob, self.timer = \
+      self.step(state=self.state, direction=self.direction, wait_timer=self.wait_timer,
+                ll_prob=self.ll_prob, timer=self.timer, cancel=cancel,
+                left_blinker=left_blinker, right_blinker=right_blinker,
+                prev_one_blinker=self.prev_one_blinker, below_lane_change_speed=below_lane_change_speed,
+                steering_pressed=steering_pressed, steering_torque=steering_torque,
+                left_blindspot=left_blindspot, right_blindspot=right_blindspot,
+                lane_change_prob=lane_change_prob, adjust=adjust, auto_delay=self.auto_delay, dt=DT)
+    self.prev_one_blinker = left_blinker != right_blinker
+    return self.state
+
+
+class TestLaneChangeFSM(unittest.TestCase):
+  def start_left_lane_change(self, lc):
+    self.assertEqual(lc.update(left_blinker=True), LaneChangeState.preLaneChange)
+    self.assertEqual(lc.update(left_blinker=True, steering_pressed=True, steering_torque=1.0),
+                     LaneChangeState.laneChangeStarting)
+    self.assertEqual(lc.direction, LaneChangeDirection.left)
+
+  def test_full_lane_change(self):
+    lc = LaneChange(lane_change_fsm.step)
+    self.start_left_lane_change(lc)
+
+    # lanelines fade out while the model still sees the lane change
+    for _ in range(20):
+      self.assertEqual(lc.update(lane_change_prob=0.5), LaneChangeState.laneChangeStarting)
+    self.assertEqual(lc.ll_prob, 0.0)
+    self.assertAlmostEqual(lc.timer, 21 * DT)
+
+    self.assertEqual(lc.update(), LaneChangeState.laneChangeFinishing)
+    for _ in range(19):
+      self.assertEqual(lc.update(), LaneChangeState.laneChangeFinishing)
+    self.assertEqual(lc.update(), LaneChangeState.off)
+    self.assertEqual(lc.timer, 0.0)
+
+  def test_cancel(self):
+    lc = LaneChange(lane_change_fsm.step)
+    self.start_left_lane_change(lc)
+    self.assertEqual(lc.update(left_blinker=True, lane_change_prob=0.5, cancel=True), LaneChangeState.off)
+    self.assertEqual(lc.direction, LaneChangeDirection.none)
+    self.assertEqual(lc.timer, 0.0)
+
+    # holding the blinker does not restart it, a new blinker press is needed
+    self.assertEqual(lc.update(left_blinker=True), LaneChangeState.off)
+
+  def test_blindspot_blocks_start(self):
+    lc = LaneChange(lane_change_fsm.step, auto_delay=0.2)
+    self.assertEqual(lc.update(left_blinker=True), LaneChangeState.preLaneChange)
+    for _ in range(20):
+      self.assertEqual(lc.update(left_blinker=True, left_blindspot=True, steering_pressed=True, steering_torque=1.0),
+                       LaneChangeState.preLaneChange)
+
+    # a car in the other blindspot does not block it
+    self.assertEqual(lc.update(left_blinker=True, right_blindspot=True, steering_pressed=True, steering_torque=1.0),
+                     LaneChangeState.laneChangeStarting)
+
+  def test_no_auto_delay_needs_torque(self):
+    lc = LaneChange(lane_change_fsm.step, auto_delay=0.0)
+    self.assertEqual(lc.update(right_blinker=True), LaneChangeState.preLaneChange)
+    for _ in range(100):
+      self.assertEqual(lc.update(right_blinker=True), LaneChangeState.preLaneChange)
+
+    # torque towards the wrong side does not start it either
+    self.assertEqual(lc.update(right_blinker=True, steering_pressed=True, steering_torque=1.0),
+                     LaneChangeState.preLaneChange)
+    self.assertEqual(lc.update(right_blinker=True, steering_pressed=True, steering_torque=-1.0),
+                     LaneChangeState.laneChangeStarting)
+    self.assertEqual(lc.direction, LaneChangeDirection.right)
+
+  def test_auto_delay(self):
+    lc = LaneChange(lane_change_fsm.step, auto_delay=0.5)
+    self.assertEqual(lc.update(left_blinker=True), LaneChangeState.preLaneChange)
+    for _ in range(9):
+      self.assertEqual(lc.update(left_blinker=True), LaneChangeState.preLaneChange)
+    for _ in range(2):
+      lc.update(left_blinker=True)
+    self.assertEqual(lc.state, LaneChangeState.laneChangeStarting)
+    self.assertGreater(lc.wait_timer, 0.5)
+
+  def test_finishing_rearms(self):
+    lc = LaneChange(lane_change_fsm.step)
+    self.start_left_lane_change(lc)
+    while lc.state == LaneChangeState.laneChangeStarting:
+      lc.update(left_blinker=True)
+    self.assertEqual(lc.state, LaneChangeState.laneChangeFinishing)
+
+    # blinker still on once the lanelines are back goes to the next lane change
+    while lc.state == LaneChangeState.laneChangeFinishing:
+      lc.update(left_blinker=True)
+    self.assertEqual(lc.state, LaneChangeState.preLaneChange)
+    self.assertEqual(lc.ll_prob, 1.0)
+
+  def test_old_equal_new(self):
+    random.seed(0)
+    for _ in range(200):
+      auto_delay = random.choice([0.0, 0.2, 0.5, 1.0])
+      lc, lc_old = LaneChange(lane_change_fsm.step, auto_delay), LaneChange(lane_change_fsm_old.step, auto_delay)
+      for _ in range(100):
+        inputs = {
+          'left_blinker': random.random() < 0.6,
+          'right_blinker': random.random() < 0.2,
+          'cancel': random.random() < 0.02,
+          'below_lane_change_speed': random.random() < 0.05,
+          'steering_pressed': random.random() < 0.3,
+          'steering_torque': random.uniform(-1.0, 1.0),
+          'left_blindspot': random.random() < 0.1,
+          'right_blindspot': random.random() < 0.1,
+          'lane_change_prob': random.choice([0.0, 0.01, 0.5, 1.0]),
+          'adjust': random.uniform(0.5, 3.0),
+        }
+        lc.update(**inputs)
+        lc_old.update(**inputs)
+        self.assertEqual(lc.state, lc_old.state)
+        self.assertEqual(lc.direction, lc_old.direction)
+        self.assertAlmostEqual(lc.wait_timer, lc_old.wait_timer)
+        self.assertAlmostEqual(lc.ll_prob, lc_old.ll_prob)
+        self.assertAlmostEqual(lc.timer, lc_old.timer)
+
+
+if __name__ == "__main__":
+  unittest.main()